@@ -17,6 +17,52 @@ import re
 from pydantic import BaseModel, Field
 from typing import Optional
 
+# RE2 (linear-time DFA matching) is used for long texts with unbalanced delimiters
+# when google-re2 is installed.
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# Single alternation over all supported LaTeX formats, compiled once at import time.
+# $$...$$ is listed before $...$ so it wins at the same position. RE2 has no
+# lookaround, so $...$ (group 1) is matched as-is and _pad rejects matches that
+# touch another '$'. Display math ($$...$$ and \[...\]) may span lines; inline
+# math stays on a single line.
+_LATEX_PATTERN = (
+    r"(?s:\$\$.*?\$\$)"
+    r"|(\$[^$\n]*\$)"
+    r"|(?s:\\\[.*?\\\])"
+    r"|\\\(.*?\\\)"
+)
+_RE_LATEX = re.compile(_LATEX_PATTERN)
+# RE2 never backtracks, but calling _pad through its wrapper is ~10x slower than
+# with re. re only degrades when delimiters are left unclosed (every unclosed \[,
+# \( or $$ rescans the rest of the text), so RE2 is reserved for texts of at least
+# _RE2_MIN_LEN chars where the delimiter counts do not match up.
+_RE2_LATEX = re2.compile(_LATEX_PATTERN) if re2 is not None else None
+_RE2_MIN_LEN = 8192
+
+# Maximum number of produced outputs remembered by Filter.outlet.
+_PROCESSED_CACHE_SIZE = 256
+
+
+def _pad(match) -> str:
+    if match.group(1) is not None:
+        # $...$ directly next to another '$' is part of a $$...$$ run => leave it alone
+        text, start, end = match.string, match.start(), match.end()
+        if (start and text[start - 1] == "$") or text[end : end + 1] == "$":
+            return match.group(0)
+    return f" {match.group(0)} "
+
+
+def _unbalanced(text: str) -> bool:
+    return (
+        text.count("$$") % 2 == 1
+        or text.count("\\[") != text.count("\\]")
+        or text.count("\\(") != text.count("\\)")
+    )
+
 
 class Filter:
     class Valves(BaseModel):
@@ -25,6 +71,9 @@ class Filter:
 
     def __init__(self):
         self.valves = self.Valves()
+        # Recently produced outputs (insertion-ordered dict used as a set). Open WebUI
+        # re-sends earlier messages as fresh objects, so they are recognised by content.
+        self._processed: dict[str, None] = {}
 
     def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         # This filter does not modify input data.
@@ -44,25 +93,43 @@ class Filter:
             return body
 
         messages = body.get("messages", [])
+        if not messages:
+            return body
         for message in messages:
             # Process only 'assistant' messages.
             if message.get("role") == "assistant" and isinstance(
                 message.get("content"), str
             ):
-                message["content"] = self._add_spaces_to_latex(message["content"])
+                content = message["content"]
+                if content in self._processed:
+                    # Already padded by an earlier call => padding again would add more spaces
+                    continue
+                new = self._add_spaces_to_latex(content)
+                # Without LaTeX the same object comes back => leave the message untouched
+                if new is not content:
+                    message["content"] = new
+                    self._remember(new)
         return body
 
+    def _remember(self, content: str) -> None:
+        """
+        Internal method: Records a produced output, evicting the oldest entry (FIFO)
+        once the cache is full.
+        """
+        self._processed.pop(content, None)
+        if len(self._processed) >= _PROCESSED_CACHE_SIZE:
+            del self._processed[next(iter(self._processed))]
+        self._processed[content] = None
+
     def _add_spaces_to_latex(self, text: str) -> str:
         """
         Internal method: Detects LaTeX expressions in the text and adds spaces before and after them.
         Supports formats: $$...$$, $...$, \[...\] and \( ... \)
         """
-        # Process $$...$$ format first to avoid false matches by the single $...$ regex.
-        text = re.sub(r"(\$\$.*?\$\$)", r" \1 ", text)
-        # Process $...$ format using negative lookbehind and lookahead to avoid matching $$...$$.
-        text = re.sub(r"(?<!\$)(\$.*?\$)(?!\$)", r" \1 ", text)
-        # Process \[...\] format.
-        text = re.sub(r"(\\\[.*?\\\])", r" \1 ", text)
-        # Process \( ... \) format.
-        text = re.sub(r"(\\\(.*?\\\))", r" \1 ", text)
-        return text
+        # Most messages contain no LaTeX at all; skip the regex engine for them.
+        if "$" not in text and "\\[" not in text and "\\(" not in text:
+            return text
+        # One pass over the text covers all four formats.
+        if _RE2_LATEX is not None and len(text) >= _RE2_MIN_LEN and _unbalanced(text):
+            return _RE2_LATEX.sub(_pad, text)
+        return _RE_LATEX.sub(_pad, text)
@@ -18,6 +18,28 @@ import traceback
 from typing import AsyncGenerator, Callable, Awaitable
 from pydantic import BaseModel, Field
 
+# Prefer orjson for parsing the per-chunk SSE payloads when it is installed.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so error handling is unchanged.
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+
+_DATA_PREFIX = b"data:"
+_DATA_PREFIX_LEN = len(_DATA_PREFIX)
+
+# Tags rewritten by the streaming parser and their replacements
+_LT = "<think>"
+_LT_N = len(_LT)
+_LTE = "</think>"
+_LTE_N = len(_LTE)
+_OPEN = "\n```Reasoning...\n"
+_CLOSE = "\n```\n"
+
+# Role inserted between two consecutive messages of the same role; any other role
+# (e.g. "system") falls back to "user"
+_ALT_ROLE = {"user": "assistant", "assistant": "user"}
+
 
 class Pipe:
     class Valves(BaseModel):
@@ -32,11 +54,16 @@ class Pipe:
             default="deepseek-reasoner",
             description="Name of the model for API requests, default 'deepseek-reasoner'. For multiple models, separate names with commas.",
         )
+        DEBUG: bool = Field(
+            default=False,
+            description="Return the full traceback on errors instead of only the exception type and message",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
-        self.data_prefix = "data:"
         self.emitter = None
+        # Long-lived client so connections (and HTTP/2 streams) are reused across requests
+        self._client: httpx.AsyncClient | None = None
 
     def pipes(self):
         models = self.valves.API_MODEL.split(",")
@@ -47,6 +74,7 @@ class Pipe:
     ) -> AsyncGenerator[str, None]:
         """
         Streaming output with per-chunk post-processing. No longer splits on '\n' to avoid random line breaks.
+        <think> / </think> tags are rewritten by a state machine that runs across the whole response.
         """
         self.emitter = __event_emitter__
         if not self.valves.API_KEY:
@@ -58,53 +86,61 @@ class Pipe:
             "Content-Type": "application/json",
         }
 
+        # Assign a separate tag-parser state for each request:
+        #   - first_think_found: the opening "```Reasoning..." block has been emitted
+        #   - in_think: currently inside the reasoning block
+        #   - pending: a possible tag prefix held back at the end of the previous chunk
+        context = {"first_think_found": False, "in_think": False, "pending": ""}
+        # Processed text collected for the current network read, yielded in one piece
+        out = []
+
         try:
             # Only take the last part of the model name
             model_id = body["model"].split(".", 1)[-1]
-            payload = {**body, "model": model_id}
-            messages = payload["messages"]
-
-            # Correct consecutive identical roles
-            for i in range(len(messages) - 1, 0, -1):
-                if messages[i]["role"] == messages[i - 1]["role"]:
-                    alt_role = "assistant" if messages[i]["role"] == "user" else "user"
-                    messages.insert(
-                        i, {"role": alt_role, "content": "[Unfinished thinking]"}
-                    )
-
-            # Assign a separate chunk_buffer and context for each request
-            chunk_buffer = []  # Buffer for chunks that are not yet determined for processing
-            context = {"first_think_found": False}
-
-            async with httpx.AsyncClient(http2=True) as client:
-                async with client.stream(
-                    "POST",
-                    f"{self.valves.API_BASE_URL}/chat/completions",
-                    json=payload,
-                    headers=headers,
-                    timeout=300,
-                ) as response:
-                    if response.status_code != 200:
-                        error = await response.aread()
-                        yield self._format_error(response.status_code, error)
-                        return
+            messages = body["messages"]
 
-                    async for raw_line in response.aiter_lines():
-                        if not raw_line.startswith(self.data_prefix):
-                            continue
+            # Correct consecutive identical roles, rebuilding the list in a single pass
+            fixed = messages[:1]
+            for message in messages[1:]:
+                if message["role"] == fixed[-1]["role"]:
+                    alt_role = _ALT_ROLE.get(message["role"], "user")
+                    fixed.append({"role": alt_role, "content": "[Unfinished thinking]"})
+                fixed.append(message)
+
+            # New dict: Open WebUI keeps reading the caller's body while the stream is drained
+            payload = {**body, "model": model_id, "messages": fixed}
+
+            client = await self._get_client()
+            async with client.stream(
+                "POST",
+                f"{self.valves.API_BASE_URL}/chat/completions",
+                json=payload,
+                headers=headers,
+                timeout=300,
+            ) as response:
+                if response.status_code != 200:
+                    error = await response.aread()
+                    yield self._format_error(response.status_code, error)
+                    return
 
-                        json_str = raw_line[len(self.data_prefix):].strip()
+                # Local aliases avoid attribute lookups for every streamed delta
+                transform = self._transform_chunk
+                loads = _json.loads
+                async for batch in self._iter_sse_data(response):
+                    done = False
+                    for json_str in batch:
                         if json_str == "[DONE]":
-                            # Final signal => force-process all remaining chunks and output
-                            async for final_chunk in self._finalize_all_chunks(
-                                chunk_buffer, context
-                            ):
-                                yield final_chunk
-                            return
+                            # Final signal => flush whatever the parser is still holding
+                            done = True
+                            break
 
                         try:
-                            data = json.loads(json_str)
+                            data = loads(json_str)
                         except json.JSONDecodeError as e:
+                            # Flush collected and held-back text before reporting the error
+                            tail = "".join(out) + self._finish_stream(context)
+                            if tail:
+                                yield tail
                             error_detail = f"Failed to parse JSON - content: {json_str}, reason: {e}"
                             yield self._format_error("JSONDecodeError", error_detail)
                             return
@@ -115,119 +151,149 @@ class Pipe:
 
                         choice = choices[0]
                         if choice.get("finish_reason"):
-                            # Also force output remaining chunks
-                            async for final_chunk in self._finalize_all_chunks(
-                                chunk_buffer, context
-                            ):
-                                yield final_chunk
-                            return
+                            # Also flush the parser
+                            done = True
+                            break
 
                         reasoning_part = choice["delta"].get("reasoning_content", "")
                         content_part = choice["delta"].get("content", "")
                         new_chunk = reasoning_part + content_part
 
-                        # Append the new chunk to the buffer
-                        chunk_buffer.append(new_chunk)
+                        # Collect everything that is already decidable
+                        out.append(transform(new_chunk, context))
 
-                        # Try to process chunks that can be finalized
-                        finalized = self._try_finalize_chunks(
-                            chunk_buffer, context, partial=True
-                        )
-                        for fc in finalized:
-                            # Note: no extra newline appended at the end here
-                            yield fc
+                    if done:
+                        out.append(self._finish_stream(context))
+                    # One yield per network read instead of one per delta
+                    processed = "".join(out)
+                    out.clear()
+                    if processed:
+                        # Note: no extra newline appended at the end here
+                        yield processed
+                    if done:
+                        return
+
+                # Stream ended without [DONE] or finish_reason => flush the parser as well
+                tail = self._finish_stream(context)
+                if tail:
+                    yield tail
 
         except Exception as e:
-            # On error, also force output all remaining buffered chunks
-            async for fc in self._finalize_all_chunks(chunk_buffer, context):
-                yield fc
+            # On error, also flush whatever was collected or is still held by the parser
+            tail = "".join(out) + self._finish_stream(context)
+            if tail:
+                yield tail
             yield self._format_exception(e)
 
-    def _try_finalize_chunks(self, buffer, context, partial=True):
+    async def _iter_sse_data(self, response) -> AsyncGenerator[list[str], None]:
         """
-        When partial=True (stream in progress):
-         - We only process "determinable" chunks (especially checking if '</think>' is the last occurrence).
-         - If there are fewer than 5 subsequent chunks to confirm, leave it in the buffer until more data arrives.
-        Returns a list of processed chunks, which are removed from the buffer; undetermined chunks remain in the buffer.
+        Frame the raw SSE byte stream into lines and, for each network read, yield the
+        stripped payloads of its complete 'data:' lines as one list. Pings, comments and
+        empty lines are skipped without being decoded.
         """
-        finalized = []
-        i = 0
-        while i < len(buffer):
-            chunk = buffer[i]
-            # There may be multiple <think> / </think> tags in this chunk.
-            # First check if </think> requires lookahead (5 chunks).
-            # If the chunk itself contains multiple </think>, process them all.
-
-            # If lookahead is needed and partial=True & fewer than 5 subsequent chunks, skip processing
-            if "</think>" in chunk:
-                if partial and (i + 5 >= len(buffer)):
-                    # Indeterminate => keep in buffer, await more chunks or end of stream
+        # Local aliases keep global lookups out of the per-line loop
+        prefix = _DATA_PREFIX
+        plen = _DATA_PREFIX_LEN
+        buf = bytearray()
+        find = buf.find
+        startswith = buf.startswith
+        async for raw in response.aiter_bytes():
+            buf += raw
+            batch = []
+            start = 0
+            while True:
+                end = find(b"\n", start)
+                if end < 0:
                     break
-                else:
-                    # Determinable => pop from buffer for processing
-                    buffer.pop(i)
-                    # Check if any of the next 5 chunks contain </think>
-                    next_5 = buffer[i : i + 5]
-                    has_more_think = any("</think>" in c for c in next_5)
-                    # If '</think>' appears within the next 5, this occurrence is not the last
-                    processed = self._transform_chunk(
-                        chunk, is_last_think=not has_more_think, context=context
-                    )
-                    finalized.append(processed)
-                    continue
-            else:
-                # No '</think>' => can pop and process immediately
-                buffer.pop(i)
-                processed = self._transform_chunk(chunk, is_last_think=False, context=context)
-                finalized.append(processed)
-                continue
+                if startswith(prefix, start, end):
+                    batch.append(buf[start + plen : end].strip().decode(errors="replace"))
+                start = end + 1
+            # Keep only the trailing partial line for the next read
+            del buf[:start]
+            if batch:
+                yield batch
+        # Stream ended without a trailing newline
+        if startswith(prefix):
+            yield [buf[plen:].strip().decode(errors="replace")]
 
-            i += 1
+    async def _get_client(self) -> httpx.AsyncClient:
+        """
+        Lazily create the shared HTTP client on first use (or after it has been closed).
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=300,
+                limits=httpx.Limits(max_keepalive_connections=16),
+            )
+        return self._client
 
-        return finalized
+    async def close(self):
+        """
+        Close the shared HTTP client and release its pooled connections.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-    async def _finalize_all_chunks(self, buffer, context):
+    def _transform_chunk(self, chunk: str, context: dict) -> str:
         """
-        Called when stream ends or on exception to force-process all chunks in buffer:
-         - There are no subsequent 5 chunks for any '</think>', so all are considered the last occurrence.
-         - Transform all chunks into final form and yield them.
+        Feed one streamed chunk through the <think> / </think> state machine and return
+        the text that can be emitted right away:
+         - First <think> => "\n```Reasoning...\n"; subsequent ones are deleted.
+         - </think> inside the reasoning block => "\n```\n"; any other </think> is deleted.
+         - A possible tag prefix at the end of the chunk (at most 7 chars, i.e. shorter
+           than "</think>") is kept in context["pending"] until the next chunk decides it.
         """
-        while buffer:
-            chunk = buffer.pop(0)
-            # Force treat as last occurrence to prevent leftovers
-            chunk = self._transform_chunk(chunk, is_last_think=True, context=context)
-            yield chunk
-
-    def _transform_chunk(self, chunk: str, is_last_think: bool, context: dict) -> str:
-        # Process multiple <think>/<</think> tags within a single chunk:
-        #   - First <think> => replace with "\n```Reasoning...\n"; delete subsequent ones.
-        #   - '</think>' replaced with "\n```\n" if is_last_think, else removed.
-        result = chunk
-        # Handle multiple occurrences of <think>
-        while "<think>" in result:
-            idx = result.index("<think>")
-            if not context["first_think_found"]:
-                # On first occurrence => special replacement
-                result = (
-                    result[:idx] + "\n```Reasoning...\n" + result[idx + len("<think>") :]
-                )
-                context["first_think_found"] = True
-            else:
+        text = context["pending"] + chunk
+        context["pending"] = ""
+        pos = text.find("<")
+        if pos < 0:
+            # No tag can start here => pass the chunk through untouched
+            return text
+
+        parts = [text[:pos]]
+        n = len(text)
+        while pos >= 0:
+            if text.startswith(_LT, pos):
+                if not context["first_think_found"]:
+                    # On first occurrence => special replacement
+                    context["first_think_found"] = True
+                    context["in_think"] = True
+                    parts.append(_OPEN)
                 # Subsequent <think> => delete
-                result = result[:idx] + result[idx + len("<think>") :]
-        # Handle multiple occurrences of </think>
-        while "</think>" in result:
-            idx = result.index("</think>")
-            if is_last_think:
-                result = result[:idx] + "\n```\n" + result[idx + len("</think>") :]
+                start = pos + _LT_N
+            elif text.startswith(_LTE, pos):
+                if context["in_think"]:
+                    context["in_think"] = False
+                    parts.append(_CLOSE)
+                # Stray </think> => delete
+                start = pos + _LTE_N
+            elif n - pos < _LTE_N and (
+                _LT.startswith(text[pos:]) or _LTE.startswith(text[pos:])
+            ):
+                # Possible tag cut off at the end of the chunk => decide on the next one
+                context["pending"] = text[pos:]
+                return "".join(parts)
             else:
-                # If not last occurrence => remove tags
-                result = result[:idx] + result[idx + len("</think>") :]
-        # Remove leftover fragments in order: '/think>', 'think>', 'hink>', 'ink>', 'nk>', 'k>'
-        for pattern in ["/think>", "think>", "hink>", "ink>", "nk>", "k>"]:
-            result = result.replace(pattern, "")
+                # Not a tag => keep the '<' as text
+                parts.append("<")
+                start = pos + 1
+            pos = text.find("<", start)
+            parts.append(text[start:] if pos < 0 else text[start:pos])
+        return "".join(parts)
 
-        return result
+    def _finish_stream(self, context: dict) -> str:
+        """
+        Called when the stream ends or on exception: release any held-back text and
+        close the reasoning block if it is still open.
+        """
+        tail = context["pending"]
+        context["pending"] = ""
+        if context["in_think"]:
+            context["in_think"] = False
+            tail += "\n```\n"
+        return tail
 
     def _emit_status(self, description: str, done: bool = False) -> Awaitable[None]:
         if self.emitter:
@@ -250,6 +316,10 @@ class Pipe:
         )
 
     def _format_exception(self, e: Exception) -> str:
-        tb_lines = traceback.format_exception(type(e), e, e.__traceback__)
-        detailed_error = "".join(tb_lines)
+        if self.valves.DEBUG:
+            tb_lines = traceback.format_exception(type(e), e, e.__traceback__)
+            detailed_error = "".join(tb_lines)
+        else:
+            # Default: cheap summary that does not expose server paths to the client
+            detailed_error = f"{type(e).__name__}: {e}"
         return json.dumps({"error": detailed_error}, ensure_ascii=False)